@@ -1,169 +1,385 @@
 from __future__ import annotations
-import datetime
+import asyncio
+import functools
 import logging
+from collections import OrderedDict
 import anthropic
 import httpx
 import os
-import json
-from tenacity import retry, stop_after_attempt, wait_fixed, retry_if_exception_type
+import random
+import sys
+import time
+from tenacity import retry, stop_after_attempt, wait_random_exponential, retry_if_exception_type, \
+    before_sleep_log
+
+try:
+    import orjson as json_parser
+except ImportError:
+    import json as json_parser
 
 # Load translations
 parent_dir_path = os.path.join(os.path.dirname(__file__), os.pardir)
 translations_file_path = os.path.join(parent_dir_path, 'translations.json')
-with open(translations_file_path, 'r', encoding='utf-8') as f:
-    translations = json.load(f)
+with open(translations_file_path, 'rb') as f:
+    raw_translations = json_parser.loads(f.read())
+# Intern language codes, keys and strings so localized_text lookups compare by identity
+translations = {
+    sys.intern(lang): {
+        sys.intern(key): sys.intern(value) if isinstance(value, str) else value
+        for key, value in texts.items()
+    }
+    for lang, texts in raw_translations.items()
+}
+
+# Minimum growth (in characters) or elapsed time (in seconds) between intermediate stream updates
+STREAM_YIELD_MIN_CHARS = 80
+STREAM_YIELD_MIN_SECONDS = 0.4
+
+# Polling interval bounds and overall time limit (in seconds) for batched summaries
+BATCH_POLL_MIN_SECONDS = 5
+BATCH_POLL_MAX_SECONDS = 60
+BATCH_SUMMARY_TIMEOUT_SECONDS = 30 * 60
+
+# Context window (input + output tokens) of current Claude models
+DEFAULT_CONTEXT_TOKENS = 200000
+
+# Upper bound (in seconds) for a single wait between chat request retries
+RETRY_MAX_WAIT_SECONDS = 60
+
+_rate_limit_backoff = wait_random_exponential(multiplier=2, max=RETRY_MAX_WAIT_SECONDS)
+
+def wait_for_rate_limit(retry_state) -> float:
+    """
+    Tenacity wait strategy honouring the server's Retry-After header (plus jitter, capped at
+    RETRY_MAX_WAIT_SECONDS) when present, falling back to randomized exponential backoff otherwise.
+    """
+    response = getattr(retry_state.outcome.exception(), 'response', None)
+    retry_after = response.headers.get('retry-after') if response is not None else None
+    if retry_after:
+        try:
+            return min(float(retry_after), RETRY_MAX_WAIT_SECONDS) + random.uniform(0, 1)
+        except ValueError:
+            pass
+    return _rate_limit_backoff(retry_state)
 
 def default_max_tokens(model: str) -> int:
-    return 8192 if "sonet" in model else 4000
+    model = model.lower()
+    # Claude 3 models are limited to 4096 output tokens
+    if any(family in model for family in ("claude-3-opus", "claude-3-sonnet", "claude-3-haiku")):
+        return 4096
+    # Claude 3.5 / 3.7 Sonnet and Claude 3.5 Haiku
+    if "sonnet" in model or "haiku" in model:
+        return 8192
+    return 4000
 
+@functools.lru_cache(maxsize=1024)
 def localized_text(key, bot_language):
     """
     Return translated text for a key in specified bot_language.
     Keys and translations can be found in the translations.json.
+    Translations never change after import, so lookups are cached.
     """
-    try:
-        return translations[bot_language][key]
-    except KeyError:
-        logging.warning(f"No translation available for bot_language code '{bot_language}' and key '{key}'")
-        # Fallback to English if the translation is not available
-        if key in translations['en']:
-            return translations['en'][key]
-        else:
-            logging.warning(f"No english definition found for key '{key}' in translations.json")
-            # return key as text
-            return key
+    text = translations.get(bot_language, {}).get(key)
+    if text is not None:
+        return text
+
+    logging.warning("No translation available for bot_language code '%s' and key '%s'", bot_language, key)
+    # Fallback to English if the translation is not available
+    text = translations['en'].get(key)
+    if text is None:
+        logging.warning("No english definition found for key '%s' in translations.json", key)
+        # return key as text
+        return key
+    return text
 
 class BotHelper:
     def __init__(self, config: dict):
-        http_client = httpx.AsyncClient(proxy=config['proxy']) if 'proxy' in config else None
+        # HTTP/2 multiplexes concurrent (streaming) requests over pooled connections
+        http_client = httpx.AsyncClient(
+            proxy=config.get('proxy'),
+            http2=True,
+            limits=httpx.Limits(max_connections=200, max_keepalive_connections=50, keepalive_expiry=30.0),
+            timeout=httpx.Timeout(connect=10.0, read=600.0, write=60.0, pool=5.0)
+        )
         self.client = anthropic.AsyncAnthropic(
             api_key=config['api_key'],
             http_client=http_client
         )
+        # Chat requests are retried by tenacity only (see __create_message), so the client must not retry as well
+        self._chat_client = self.client.with_options(max_retries=0)
         self.config = config
-        self.conversations: dict[int: list] = {}
-        self.conversations_vision: dict[int: bool] = {}
-        self.last_updated: dict[int: datetime] = {}
+        # Settings are fixed for the process, so resolve them once instead of per message
+        self._model = config['model']
+        self._temperature = config['temperature']
+        self._max_tokens = config['max_tokens']
+        self._assistant_prompt = config['assistant_prompt']
+        self._bot_language = config['bot_language']
+        self._show_usage = config['show_usage']
+        self._usage_suffix_fmt = "\n\n---\n💰 {} " + localized_text('stats_tokens', self._bot_language)
+        self._err_prefix = f"⚠️ _{localized_text('error', self._bot_language)}._ ⚠️\n"
+        self._bad_req_prefix = f"⚠️ _{localized_text('invalid_request', self._bot_language)}._ ⚠️\n"
+        self._max_age_seconds = config['max_conversation_age_minutes'] * 60
+        self._max_sessions = config.get('max_sessions', 10000)
+        self._max_context_tokens = config.get('max_context_tokens', DEFAULT_CONTEXT_TOKENS)
+        self._max_history_size = config['max_history_size']
+        self._use_batch_summaries = config.get('use_batch_summaries', False)
+        # Per-chat state, ordered from least to most recently used:
+        #   'prompt': system prompt the chat was started (or reset) with
+        #   'summary': summary of earlier messages that were dropped from the conversation, if any
+        #   'system': system message sent to the API, i.e. 'prompt' followed by 'summary'
+        #   'conversation': only user/assistant turns, in the format expected by the Anthropic API
+        #   'token_estimates': system message estimate, followed by one entry per conversation message
+        #   'token_count': running sum of 'token_estimates'
+        #   'messages_added': number of messages ever added to the conversation
+        #   'vision': whether the conversation contains images
+        #   'last_updated': monotonic timestamp (seconds) of the last request
+        self.sessions: OrderedDict[int, dict] = OrderedDict()
+        self._summarize_tasks: dict[int, asyncio.Task] = {}
 
     def get_conversation_stats(self, chat_id: int) -> tuple[int, int]:
-        if chat_id not in self.conversations:
+        if chat_id not in self.sessions:
             self.reset_chat_history(chat_id)
-        return len(self.conversations[chat_id]), self.__count_tokens(self.conversations[chat_id])
+        session = self.sessions[chat_id]
+        return len(session['conversation']), self.__count_tokens(session)
 
     async def get_chat_response(self, chat_id: int, query: str) -> tuple[str, str]:
-        response = await self.__common_get_chat_response(chat_id, query)
+        response, session = await self.__common_get_chat_response(chat_id, query)
         answer = response.content[0].text
-        self.__add_to_history(chat_id, role="assistant", content=answer)
+        self.__add_to_history(session, role="assistant", content=answer)
 
-        bot_language = self.config['bot_language']
-        if self.config['show_usage']:
-            tokens_used = self.__count_tokens(self.conversations[chat_id])
-            answer += f"\n\n---\n💰 {tokens_used} {localized_text('stats_tokens', bot_language)}"
+        tokens_used = self.__count_tokens(session)
+        if self._show_usage:
+            answer += self._usage_suffix_fmt.format(tokens_used)
 
         return answer, tokens_used
 
     async def get_chat_response_stream(self, chat_id: int, query: str):
-        response = await self.__common_get_chat_response(chat_id, query, stream=True)
+        response, session = await self.__common_get_chat_response(chat_id, query, stream=True)
         
-        answer = ''
+        parts: list[str] = []
+        answer_len = 0
+        last_yield_len = 0
+        last_yield_time = time.monotonic()
         async for chunk in response:
             if chunk.type == "content_block_delta":
-                answer += chunk.delta.text
-                yield answer, 'not_finished'
-        
-        answer = answer.strip()
-        self.__add_to_history(chat_id, role="assistant", content=answer)
-        tokens_used = str(self.__count_tokens(self.conversations[chat_id]))
+                parts.append(chunk.delta.text)
+                answer_len += len(chunk.delta.text)
+                # Coalesce deltas so the caller isn't editing the Telegram message on every token
+                now = time.monotonic()
+                if (answer_len - last_yield_len >= STREAM_YIELD_MIN_CHARS or
+                        now - last_yield_time >= STREAM_YIELD_MIN_SECONDS):
+                    last_yield_len = answer_len
+                    last_yield_time = now
+                    yield ''.join(parts), 'not_finished'
+
+        answer = ''.join(parts).strip()
+        self.__add_to_history(session, role="assistant", content=answer)
+        tokens_used = str(self.__count_tokens(session))
 
-        if self.config['show_usage']:
-            answer += f"\n\n---\n💰 {tokens_used} {localized_text('stats_tokens', self.config['bot_language'])}"
+        if self._show_usage:
+            answer += self._usage_suffix_fmt.format(tokens_used)
 
         yield answer, tokens_used
 
-    @retry(
-        reraise=True,
-        retry=retry_if_exception_type(anthropic.RateLimitError),
-        wait=wait_fixed(20),
-        stop=stop_after_attempt(3)
-    )
     async def __common_get_chat_response(self, chat_id: int, query: str, stream=False):
-        bot_language = self.config['bot_language']
+        """
+        Sends the query to the API and returns the response with the session it belongs to.
+        Callers should add the answer to that session, since the chat may be evicted from
+        `self.sessions` while the response is awaited.
+        """
+        if chat_id not in self.sessions or self.__max_age_reached(chat_id):
+            self.reset_chat_history(chat_id)
+
+        session = self.sessions[chat_id]
+        session['last_updated'] = time.monotonic()
+        self.sessions.move_to_end(chat_id)
+        self.__add_to_history(session, role="user", content=query)
+
+        # Handle history management
+        if (session['token_count'] + self._max_tokens > self._max_context_tokens or
+            len(session['conversation']) > self._max_history_size):
+            if len(session['conversation']) > 1 and chat_id not in self._summarize_tasks:
+                # Everything except the current query, which is kept as-is after summarising
+                task = asyncio.create_task(self.__summarise_in_background(
+                    chat_id, session, session['summary'], session['conversation'][:-1], session['messages_added'] - 1
+                ))
+                self._summarize_tasks[chat_id] = task
+                task.add_done_callback(lambda _: self._summarize_tasks.pop(chat_id, None))
+
+            # Answer from the most recent turns until the summary is ready
+            self.__fit_history(session)
+
         try:
-            if chat_id not in self.conversations or self.__max_age_reached(chat_id):
-                self.reset_chat_history(chat_id)
-
-            self.last_updated[chat_id] = datetime.datetime.now()
-            self.__add_to_history(chat_id, role="user", content=query)
-
-            # Handle history management
-            token_count = self.__count_tokens(self.conversations[chat_id])
-            if (token_count + self.config['max_tokens'] > self.__max_model_tokens() or 
-                len(self.conversations[chat_id]) > self.config['max_history_size']):
-                try:
-                    summary = await self.__summarise(self.conversations[chat_id][:-1])
-                    self.reset_chat_history(chat_id, self.conversations[chat_id][0]['content'])
-                    self.__add_to_history(chat_id, role="assistant", content=summary)
-                    self.__add_to_history(chat_id, role="user", content=query)
-                except Exception as e:
-                    logging.warning(f'Error summarising chat history: {str(e)}. Truncating instead...')
-                    self.conversations[chat_id] = self.conversations[chat_id][-self.config['max_history_size']:]
-
-            # Extract system message and convert history format
-            system_message = next((msg['content'] for msg in self.conversations[chat_id] if msg['role'] == 'system'), None)
-            messages = []
-            for msg in self.conversations[chat_id]:
-                if msg['role'] in ['user', 'assistant']:
-                    messages.append({"role": msg['role'], "content": msg['content']})
-
-            return await self.client.messages.create(
-                model=self.config['model'],
-                messages=messages,
-                system=system_message,  # Pass system message separately
-                temperature=self.config['temperature'],
-                max_tokens=self.config['max_tokens'],
+            response = await self.__create_message(
+                model=self._model,
+                # Snapshot, so a retry sends the same turns even if the chat receives new messages meanwhile
+                messages=list(session['conversation']),
+                system=session['system'],
+                temperature=self._temperature,
+                max_tokens=self._max_tokens,
                 stream=stream
             )
-
-        except anthropic.RateLimitError as e:
-            raise e
+            return response, session
+        except anthropic.RateLimitError:
+            raise
         except anthropic.BadRequestError as e:
-            raise Exception(f"⚠️ _{localized_text('invalid_request', bot_language)}._ ⚠️\n{str(e)}") from e
-        except Exception as e:
-            raise Exception(f"⚠️ _{localized_text('error', bot_language)}._ ⚠️\n{str(e)}") from e
+            raise Exception(f"{self._bad_req_prefix}{str(e)}") from e
+        except (anthropic.APIStatusError, anthropic.APIConnectionError) as e:
+            # Still failing after retries (connection errors) or not worth retrying (other statuses)
+            raise Exception(f"{self._err_prefix}{str(e)}") from e
+
+    @retry(
+        reraise=True,
+        retry=retry_if_exception_type((
+            anthropic.RateLimitError, anthropic.InternalServerError, anthropic.APIConnectionError
+        )),
+        wait=wait_for_rate_limit,
+        # Each attempt can take up to the client read timeout
+        stop=stop_after_attempt(3),
+        before_sleep=before_sleep_log(logging.getLogger(), logging.WARNING)
+    )
+    async def __create_message(self, **kwargs):
+        return await self._chat_client.messages.create(**kwargs)
 
     def reset_chat_history(self, chat_id, content=''):
         if content == '':
-            content = self.config['assistant_prompt']
-        self.conversations[chat_id] = [{"role": "system", "content": content}]
-        self.conversations_vision[chat_id] = False
+            content = self._assistant_prompt
+        tokens = self.__estimate_tokens(content)
+        self.sessions[chat_id] = {
+            'prompt': content,
+            'summary': None,
+            'system': content,
+            'conversation': [],
+            'token_estimates': [tokens],
+            'token_count': tokens,
+            'messages_added': 0,
+            'vision': False,
+            'last_updated': time.monotonic()
+        }
+        self.sessions.move_to_end(chat_id)
+        self.__evict_sessions()
+
+    def __evict_sessions(self):
+        """
+        Drops least recently used sessions that are either expired or over the session limit.
+        Sessions are kept in last-used order, so only the oldest entries need to be checked.
+        """
+        now = time.monotonic()
+        while self.sessions:
+            oldest = next(iter(self.sessions.values()))
+            if (len(self.sessions) <= self._max_sessions and
+                    now - oldest['last_updated'] <= self._max_age_seconds):
+                break
+            self.sessions.popitem(last=False)
 
     def __max_age_reached(self, chat_id) -> bool:
-        if chat_id not in self.last_updated:
-            return False
-        last_updated = self.last_updated[chat_id]
-        now = datetime.datetime.now()
-        max_age_minutes = self.config['max_conversation_age_minutes']
-        return last_updated < now - datetime.timedelta(minutes=max_age_minutes)
-
-    def __add_to_history(self, chat_id, role, content):
-        self.conversations[chat_id].append({"role": role, "content": content})
-
-    async def __summarise(self, conversation) -> str:
-        response = await self.client.messages.create(
-            model=self.config['model'],
-            system="Summarize this conversation in 700 characters or less",
-            messages=[{"role": "user", "content": str(conversation)}],
-            temperature=0.4,
-            max_tokens=1000
-        )
+        return time.monotonic() - self.sessions[chat_id]['last_updated'] > self._max_age_seconds
+
+    def __add_to_history(self, session, role, content):
+        tokens = self.__estimate_tokens(content)
+        session['conversation'].append({"role": role, "content": content})
+        session['token_estimates'].append(tokens)
+        session['token_count'] += tokens
+        session['messages_added'] += 1
+
+    def __truncate_history(self, session, keep: int):
+        """
+        Keeps only the last `keep` messages of the session conversation.
+        """
+        start = max(len(session['conversation']) - keep, 0)
+        session['conversation'] = session['conversation'][start:]
+        token_estimates = session['token_estimates']
+        session['token_estimates'] = token_estimates[:1] + token_estimates[1 + start:]
+        session['token_count'] = sum(session['token_estimates'])
+
+    def __fit_history(self, session):
+        """
+        Drops the oldest messages until the conversation has at most max_history_size messages
+        and leaves room for the answer in the context window. The current query is always kept,
+        and the conversation never starts with an assistant message.
+        """
+        conversation = session['conversation']
+        token_estimates = session['token_estimates']
+        start = max(len(conversation) - self._max_history_size, 0)
+        token_count = token_estimates[0] + sum(token_estimates[1 + start:])
+        while start < len(conversation) - 1 and (
+                token_count + self._max_tokens > self._max_context_tokens or
+                conversation[start]['role'] == 'assistant'):
+            token_count -= token_estimates[1 + start]
+            start += 1
+        self.__truncate_history(session, len(conversation) - start)
+
+    async def __summarise_in_background(self, chat_id, session, previous_summary, conversation,
+                                        summarised_messages: int):
+        """
+        Summarises the conversation (and any previous summary), drops the summarised messages and
+        appends the summary to the system message, so later truncation can't remove it.
+        Messages added since are kept. Skipped if the session was reset or evicted meanwhile.
+        """
+        try:
+            summary = await self.__summarise(chat_id, previous_summary, conversation)
+        except Exception as e:
+            logging.warning(f'Error summarising chat history: {str(e)}. Keeping truncated history...')
+            return
+
+        if self.sessions.get(chat_id) is not session:
+            return
+
+        session['summary'] = summary
+        session['system'] = f"{session['prompt']}\n\nSummary of the conversation so far:\n{summary}"
+        session['token_estimates'][0] = self.__estimate_tokens(session['system'])
+        self.__truncate_history(session, session['messages_added'] - summarised_messages)
+
+    async def __summarise(self, chat_id, previous_summary, conversation) -> str:
+        # Plain "role: content" lines instead of the list repr, to avoid paying for dict syntax as input tokens
+        lines = [f"summary of earlier conversation: {previous_summary}"] if previous_summary else []
+        lines.extend(f"{message['role']}: {message['content']}" for message in conversation)
+        transcript = "\n".join(lines)
+        if not transcript.strip():
+            raise ValueError('Nothing to summarise')
+        params = {
+            'model': self._model,
+            'system': "Summarize this conversation in 700 characters or less",
+            'messages': [{"role": "user", "content": transcript}],
+            'temperature': 0.4,
+            'max_tokens': 700
+        }
+        if self._use_batch_summaries:
+            return await self.__summarise_in_batch(chat_id, params)
+
+        response = await self.client.messages.create(**params)
         return response.content[0].text
 
-    def __max_model_tokens(self):
-        return default_max_tokens(self.config['model'])
+    async def __summarise_in_batch(self, chat_id, params: dict) -> str:
+        """
+        Runs the summary request through the Message Batches API, which is billed at a discount
+        but may take a while, polling with exponential backoff until the batch has ended.
+        """
+        batch = await self.client.messages.batches.create(
+            requests=[{"custom_id": f"summary-{chat_id}", "params": params}]
+        )
+        deadline = time.monotonic() + BATCH_SUMMARY_TIMEOUT_SECONDS
+        delay = BATCH_POLL_MIN_SECONDS
+        while batch.processing_status != 'ended':
+            if time.monotonic() > deadline:
+                await self.client.messages.batches.cancel(batch.id)
+                raise TimeoutError(f'Summary batch {batch.id} did not finish in time')
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, BATCH_POLL_MAX_SECONDS)
+            batch = await self.client.messages.batches.retrieve(batch.id)
+
+        async for entry in await self.client.messages.batches.results(batch.id):
+            if entry.result.type == 'succeeded':
+                return entry.result.message.content[0].text
+            raise Exception(f'Summary batch {batch.id} request {entry.result.type}')
+        raise Exception(f'Summary batch {batch.id} returned no results')
+
+    def __count_tokens(self, session) -> int:
+        # Maintained incrementally as messages are added to history
+        return session['token_count']
 
-    def __count_tokens(self, messages) -> int:
-        total_tokens = 0
-        for message in messages:
-            # Rough estimation since Claude doesn't provide exact token counting
-            total_tokens += len(message['content'].split()) * 1.3
-        return int(total_tokens)
\ No newline at end of file
+    @staticmethod
+    def __estimate_tokens(content: str) -> int:
+        # Rough estimation of ~4 characters per token, which unlike counting words
+        # also holds up for code and languages without spaces
+        return len(content) // 4
\ No newline at end of file
@@ -6,6 +6,64 @@ from dotenv import load_dotenv
 from bot_helper import BotHelper, default_max_tokens
 from telegram_bot import ChatBotTelegramBot
 
+def _bool(value: str) -> bool:
+    return value.lower() == 'true'
+
+
+def _lower(value: str) -> str:
+    return value.lower()
+
+
+# (config key, environment variable(s) in order of precedence, type, default)
+BOT_SETTINGS = [
+    ('api_key', ('ANTHROPIC_API_KEY',), str, None),
+    ('show_usage', ('SHOW_USAGE',), _bool, 'false'),
+    ('stream', ('STREAM',), _bool, 'true'),
+    ('proxy', ('PROXY',), str, None),
+    ('max_history_size', ('MAX_HISTORY_SIZE',), int, 15),
+    ('max_conversation_age_minutes', ('MAX_CONVERSATION_AGE_MINUTES',), int, 180),
+    ('max_sessions', ('MAX_SESSIONS',), int, 10000),
+    ('max_context_tokens', ('MAX_CONTEXT_TOKENS',), int, 200000),
+    ('use_batch_summaries', ('USE_BATCH_SUMMARIES',), _bool, 'false'),
+    ('assistant_prompt', ('ASSISTANT_PROMPT',), str, 'You are Claude, a helpful AI assistant created by Anthropic.'),
+    ('temperature', ('TEMPERATURE',), float, 0.7),
+    ('top_k', ('TOP_K',), int, 1),
+    ('top_p', ('TOP_P',), float, 0.7),
+    ('system_prompt', ('SYSTEM_PROMPT',), str, None),
+    ('bot_language', ('BOT_LANGUAGE',), str, 'en'),
+]
+
+TELEGRAM_SETTINGS = [
+    ('token', ('TELEGRAM_BOT_TOKEN',), str, None),
+    ('admin_user_ids', ('ADMIN_USER_IDS',), str, '-'),
+    ('allowed_user_ids', ('ALLOWED_TELEGRAM_USER_IDS',), str, '*'),
+    ('enable_quoting', ('ENABLE_QUOTING',), _bool, 'true'),
+    ('stream', ('STREAM',), _bool, 'true'),
+    ('proxy', ('PROXY',), str, None),
+    ('budget_period', ('BUDGET_PERIOD',), _lower, 'monthly'),
+    ('user_budgets', ('USER_BUDGETS', 'MONTHLY_USER_BUDGETS'), str, '10.0'),
+    ('guest_budget', ('GUEST_BUDGET', 'MONTHLY_GUEST_BUDGET'), float, '10.0'),
+    ('bot_language', ('BOT_LANGUAGE',), str, 'en'),
+    ('token_price', ('TOKEN_PRICE',), float, 0.002),
+    ('max_message_length', ('MAX_MESSAGE_LENGTH',), int, 4096),
+    ('enable_image_input', ('ENABLE_IMAGE_INPUT',), _bool, 'true'),
+    ('message_timeout', ('MESSAGE_TIMEOUT',), int, 120),
+]
+
+
+def read_settings(env, settings) -> dict:
+    """
+    Builds a config dictionary from a settings table, using the first environment variable
+    that is set for each entry and converting it to the entry's type.
+    Unset entries with a None default stay None.
+    """
+    config = {}
+    for name, keys, cast, default in settings:
+        value = next((env[key] for key in keys if key in env), default)
+        config[name] = cast(value) if value is not None else None
+    return config
+
+
 def main():
     # Read .env file
     load_dotenv()
@@ -17,55 +75,28 @@ def main():
     )
     logging.getLogger("httpx").setLevel(logging.WARNING)
 
+    env = os.environ
+
     # Check if the required environment variables are set
     required_values = ['TELEGRAM_BOT_TOKEN', 'ANTHROPIC_API_KEY']
-    missing_values = [value for value in required_values if os.environ.get(value) is None]
+    missing_values = [value for value in required_values if value not in env]
     if len(missing_values) > 0:
         logging.error(f'The following environment values are missing in your .env: {", ".join(missing_values)}')
         exit(1)
 
     # Setup configurations
-    model = os.environ.get('ANTHROPIC_MODEL', 'claude-3-5-sonnet-20241022')
-    max_tokens_default = default_max_tokens(model=model)
-
-    bot_config = {
-        'api_key': os.environ['ANTHROPIC_API_KEY'],
-        'show_usage': os.environ.get('SHOW_USAGE', 'false').lower() == 'true',
-        'stream': os.environ.get('STREAM', 'true').lower() == 'true',
-        'proxy': os.environ.get('PROXY', None),
-        'max_history_size': int(os.environ.get('MAX_HISTORY_SIZE', 15)),
-        'max_conversation_age_minutes': int(os.environ.get('MAX_CONVERSATION_AGE_MINUTES', 180)),
-        'assistant_prompt': os.environ.get('ASSISTANT_PROMPT', 'You are Claude, a helpful AI assistant created by Anthropic.'),
-        'max_tokens': int(os.environ.get('MAX_TOKENS', max_tokens_default)),
-        'temperature': float(os.environ.get('TEMPERATURE', 0.7)),
-        'model': model,
-        'top_k': int(os.environ.get('TOP_K', 1)),
-        'top_p': float(os.environ.get('TOP_P', 0.7)),
-        'system_prompt': os.environ.get('SYSTEM_PROMPT', None),
-        'bot_language': os.environ.get('BOT_LANGUAGE', 'en'),
-        'metadata': {
-            'user_id': os.environ.get('USER_ID', 'telegram_user'),
-            'conversation_id': os.environ.get('CONVERSATION_ID', 'default')
-        }
-    }
+    model = env.get('ANTHROPIC_MODEL', 'claude-3-5-sonnet-20241022')
 
-    telegram_config = {
-        'token': os.environ['TELEGRAM_BOT_TOKEN'],
-        'admin_user_ids': os.environ.get('ADMIN_USER_IDS', '-'),
-        'allowed_user_ids': os.environ.get('ALLOWED_TELEGRAM_USER_IDS', '*'),
-        'enable_quoting': os.environ.get('ENABLE_QUOTING', 'true').lower() == 'true',
-        'stream': os.environ.get('STREAM', 'true').lower() == 'true',
-        'proxy': os.environ.get('PROXY', None),
-        'budget_period': os.environ.get('BUDGET_PERIOD', 'monthly').lower(),
-        'user_budgets': os.environ.get('USER_BUDGETS', os.environ.get('MONTHLY_USER_BUDGETS', '10.0')),
-        'guest_budget': float(os.environ.get('GUEST_BUDGET', os.environ.get('MONTHLY_GUEST_BUDGET', '10.0'))),
-        'bot_language': os.environ.get('BOT_LANGUAGE', 'en'),
-        'token_price': float(os.environ.get('TOKEN_PRICE', 0.002)),
-        'max_message_length': int(os.environ.get('MAX_MESSAGE_LENGTH', 4096)),
-        'enable_image_input': os.environ.get('ENABLE_IMAGE_INPUT', 'true').lower() == 'true',
-        'message_timeout': int(os.environ.get('MESSAGE_TIMEOUT', 120))
+    bot_config = read_settings(env, BOT_SETTINGS)
+    bot_config['model'] = model
+    bot_config['max_tokens'] = int(env.get('MAX_TOKENS', default_max_tokens(model=model)))
+    bot_config['metadata'] = {
+        'user_id': env.get('USER_ID', 'telegram_user'),
+        'conversation_id': env.get('CONVERSATION_ID', 'default')
     }
 
+    telegram_config = read_settings(env, TELEGRAM_SETTINGS)
+
     bot_helper = BotHelper(config=bot_config)
     telegram_bot = ChatBotTelegramBot(config=telegram_config, bot_helper=bot_helper)
     telegram_bot.run()